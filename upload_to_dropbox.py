@@ -1,128 +1,484 @@
+import hashlib
+import json
+import mmap
 import os
+import shutil
 import sys
 import tarfile
-import tempfile
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import closing
+from datetime import datetime, timezone
 import dropbox
 from dropbox.exceptions import AuthError, ApiError
 from pathlib import Path
+from urllib3.util.retry import Retry
 
 # Configuration
 DROPBOX_FILE_PATH = '/Bots_V3_splunkapps.tar'
-TEMP_DIR = tempfile.gettempdir()
+DROPBOX_APPS_FOLDER = '/splunk_apps/current'
+DROPBOX_MANIFEST_PATH = '/splunk_apps/manifest.json'
+UPLOAD_MODES = ('master', 'folder', 'rebuild')
 MASTER_TAR_NAME = 'Bots_V3_splunkapps.tar'
+MASTER_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'splunk_backup')
+LOCAL_MASTER_PATH = os.path.join(MASTER_CACHE_DIR, MASTER_TAR_NAME)
+CHUNK_SIZE = 16 * 1024 * 1024  # concurrent sessions need a multiple of 4 MiB
+UPLOAD_WORKERS = 4
+DOWNLOAD_BUFSIZE = 1024 * 1024
+SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024
+FINISH_BATCH_LIMIT = 1000  # most entries one finish_batch call accepts
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz')
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+TAR_BUFSIZE = 2 * 1024 * 1024
+UPLOAD_STATE_FILE = '.upload_state.json'
 
 def initialize_dropbox(access_token):
-    """Initialize Dropbox client with access token."""
+    """Initialize the Dropbox client shared by every call, with access token."""
     try:
-        dbx = dropbox.Dropbox(access_token)
+        # One keep-alive pool sized for the upload workers, so TLS handshakes are paid once
+        session = dropbox.create_session(max_connections=max(UPLOAD_WORKERS, 8))
+        # Retry dropped connects on the pool; the SDK already retries 5xx and rate limits
+        session.get_adapter('https://').max_retries = Retry(connect=3, backoff_factor=0.5)
+        dbx = dropbox.Dropbox(access_token, session=session)
         dbx.users_get_current_account()
         return dbx
     except AuthError:
         print("ERROR: Invalid Dropbox access token")
         sys.exit(1)
 
-def download_from_dropbox(dbx):
-    """Download the master tar file from Dropbox."""
-    local_tar_path = os.path.join(TEMP_DIR, MASTER_TAR_NAME)
+def _remote_metadata(dbx, dropbox_path):
+    """Return the FileMetadata of a file in Dropbox, None if there isn't one."""
     try:
-        dbx.files_download_to_file(local_tar_path, DROPBOX_FILE_PATH)
-        return local_tar_path
+        return dbx.files_get_metadata(dropbox_path)
     except ApiError as err:
         if err.error.is_path() and err.error.get_path().is_not_found():
+            return None
+        raise
+
+def download_from_dropbox(dbx):
+    """Fetch the master tar into the local cache, returns its local path (None if there is no master)."""
+    try:
+        remote_master = _remote_metadata(dbx, DROPBOX_FILE_PATH)
+        if remote_master is None:
             print("Master tar file not found in Dropbox, creating new one.")
             return None
+        
+        # A copy cached by an earlier run spares downloading the whole master again;
+        # the size check rejects an obviously stale copy without reading all of it
+        if (os.path.exists(LOCAL_MASTER_PATH)
+                and os.path.getsize(LOCAL_MASTER_PATH) == remote_master.size
+                and dropbox_content_hash(LOCAL_MASTER_PATH) == remote_master.content_hash):
+            print("Using cached master tar file")
+            return LOCAL_MASTER_PATH
+        
+        os.makedirs(MASTER_CACHE_DIR, exist_ok=True)
+        _, res = dbx.files_download(DROPBOX_FILE_PATH)
+        with closing(res), open(LOCAL_MASTER_PATH, 'wb') as f:
+            res.raw.decode_content = True
+            shutil.copyfileobj(res.raw, f, DOWNLOAD_BUFSIZE)
+        return LOCAL_MASTER_PATH
+    except ApiError as err:
         print(f"Error downloading from Dropbox: {err}")
         sys.exit(1)
 
-def upload_to_dropbox(dbx, local_path):
-    """Upload file to Dropbox."""
+def _fadvise(file_obj, advice):
+    """Give the kernel an access-pattern hint for a whole file, where posix_fadvise exists."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(file_obj.fileno(), 0, 0, getattr(os, advice))
+
+def dropbox_content_hash(path):
+    """Compute the Dropbox content_hash of a local file (SHA-256 over 4 MiB block hashes)."""
+    block_hashes = hashlib.sha256()
+    with open(path, 'rb') as f:
+        # mmap can't map an empty file, whose hash is just the empty outer digest
+        if os.fstat(f.fileno()).st_size:
+            # Hash straight out of the page cache instead of copying each block into a bytes object
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                # Blocks hash independently and hashlib drops the GIL, so they run in parallel;
+                # map() hands the digests back in block order
+                with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+                    for digest in executor.map(
+                        lambda start: hashlib.sha256(view[start:start + CONTENT_HASH_BLOCK_SIZE]).digest(),
+                        range(0, len(view), CONTENT_HASH_BLOCK_SIZE),
+                    ):
+                        block_hashes.update(digest)
+    return block_hashes.hexdigest()
+
+def _bytes_content_hash(data):
+    """Compute the Dropbox content_hash of an in-memory payload."""
+    block_hashes = hashlib.sha256()
+    for start in range(0, len(data), CONTENT_HASH_BLOCK_SIZE):
+        block_hashes.update(hashlib.sha256(data[start:start + CONTENT_HASH_BLOCK_SIZE]).digest())
+    return block_hashes.hexdigest()
+
+def _remote_files(dbx, folder):
+    """Return {name: FileMetadata} for the files in a Dropbox folder, empty if it doesn't exist."""
+    try:
+        result = dbx.files_list_folder(folder)
+    except ApiError as err:
+        if err.error.is_path() and err.error.get_path().is_not_found():
+            return {}
+        raise
+    files = {}
+    while True:
+        for entry in result.entries:
+            if isinstance(entry, dropbox.files.FileMetadata):
+                files[entry.name] = entry
+        if not result.has_more:
+            return files
+        result = dbx.files_list_folder_continue(result.cursor)
+
+def _append_chunk(dbx, fd, session_id, offset, length, close):
+    """Read one chunk at its offset and append it to an upload session."""
+    chunk = os.pread(fd, length, offset)
+    cursor = dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset)
+    dbx.files_upload_session_append_v2(chunk, cursor, close=close)
+
+def _append_session(dbx, file_obj, file_size):
+    """Send an open file through a concurrent upload session, several chunks at a time, returns its end cursor."""
+    session = dbx.files_upload_session_start(b'', session_type=dropbox.files.UploadSessionType.concurrent)
+    fd = file_obj.fileno()
+
+    # The closing append must be the session's last, so the tail waits for every full chunk
+    tail_offset = (file_size - 1) // CHUNK_SIZE * CHUNK_SIZE
+
+    # Each worker reads its own chunk, so at most UPLOAD_WORKERS chunks are in memory
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(_append_chunk, dbx, fd, session.session_id, offset, CHUNK_SIZE, False)
+            for offset in range(0, tail_offset, CHUNK_SIZE)
+        ]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            future.result()
+
+    _append_chunk(dbx, fd, session.session_id, tail_offset, file_size - tail_offset, True)
+    return dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=file_size)
+
+def _commit_info(local_path, dropbox_path):
+    """Return the overwrite CommitInfo for a file, with its mtime as client_modified."""
+    # Dropbox keeps client_modified as whole seconds of naive UTC
+    mtime = datetime.fromtimestamp(os.path.getmtime(local_path), tz=timezone.utc)
+    return dropbox.files.CommitInfo(path=dropbox_path, mode=dropbox.files.WriteMode.overwrite,
+                                    client_modified=mtime.replace(tzinfo=None, microsecond=0))
+
+def _chunked_upload(dbx, file_obj, file_size, commit):
+    """Upload an open file through a concurrent upload session and commit it."""
+    cursor = _append_session(dbx, file_obj, file_size)
+    dbx.files_upload_session_finish(b'', cursor, commit)
+
+def _stage_upload(dbx, local_path):
+    """Send a file through a closed upload session without committing it, returns its end cursor."""
+    file_size = os.path.getsize(local_path)
+    with open(local_path, 'rb') as f:
+        _fadvise(f, 'POSIX_FADV_SEQUENTIAL')
+        if file_size < SIMPLE_UPLOAD_LIMIT:
+            session = dbx.files_upload_session_start(f.read(), close=True)
+            cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=file_size)
+        else:
+            cursor = _append_session(dbx, f, file_size)
+        _fadvise(f, 'POSIX_FADV_DONTNEED')
+    return cursor
+
+def upload_to_dropbox(dbx, local_path, dropbox_path=DROPBOX_FILE_PATH, remote_hash=None):
+    """Upload file to Dropbox in chunks, skipping it when it matches the known remote_hash."""
     try:
+        if remote_hash and dropbox_content_hash(local_path) == remote_hash:
+            print(f"{dropbox_path} is already up to date, skipping upload")
+            return
+        
+        file_size = os.path.getsize(local_path)
+        commit = _commit_info(local_path, dropbox_path)
         with open(local_path, 'rb') as f:
-            dbx.files_upload(f.read(), DROPBOX_FILE_PATH, mode=dropbox.files.WriteMode.overwrite)
+            # Read once front to back, then drop it from the page cache
+            _fadvise(f, 'POSIX_FADV_SEQUENTIAL')
+            if file_size < SIMPLE_UPLOAD_LIMIT:
+                dbx.files_upload(f.read(), dropbox_path, mode=commit.mode, client_modified=commit.client_modified)
+            else:
+                _chunked_upload(dbx, f, file_size, commit)
+            _fadvise(f, 'POSIX_FADV_DONTNEED')
         print(f"Successfully uploaded {local_path} to Dropbox")
     except Exception as e:
         print(f"Error uploading to Dropbox: {e}")
         sys.exit(1)
 
-def convert_to_tgz_if_needed(file_path):
-    """Convert .tar.gz to .tgz if needed, returns new path."""
-    if file_path.endswith('.tar.gz'):
-        new_path = file_path.replace('.tar.gz', '.tgz')
-        with tarfile.open(file_path, 'r:gz') as tar:
-            with tarfile.open(new_path, 'w:gz') as new_tar:
-                for member in tar.getmembers():
-                    file_obj = tar.extractfile(member)
-                    new_tar.addfile(member, file_obj)
-        os.remove(file_path)
-        return new_path
-    return file_path
-
-def update_master_tar(master_tar_path, new_tgz_path):
-    """Update master tar with new tgz file."""
-    new_tgz_name = os.path.basename(new_tgz_path)
-    temp_tar_path = os.path.join(TEMP_DIR, f"temp_{MASTER_TAR_NAME}")
-    
-    # Create new tar if it doesn't exist
+def find_archives(root='.'):
+    """Yield paths of all archives under root, using scandir to avoid a stat per file."""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        stack.append(entry.path)
+                elif entry.name.endswith(ARCHIVE_SUFFIXES):
+                    yield entry.path
+
+def tgz_arcname(file_path):
+    """Return the name an archive gets in Dropbox, with .tar.gz shortened to .tgz (same format)."""
+    name = os.path.basename(file_path)
+    if name.endswith('.tar.gz'):
+        return name[:-len('.tar.gz')] + '.tgz'
+    return name
+
+def _append_to_tar(tar_path, new_tgz_paths):
+    """Append tgz files to a tar, creating it if it doesn't exist."""
+    with tarfile.open(tar_path, 'a:', copybufsize=TAR_BUFSIZE) as tar:
+        for new_tgz_path in new_tgz_paths:
+            tar.add(new_tgz_path, arcname=tgz_arcname(new_tgz_path))
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    """Copy count bytes from offset in src_fd to the current position of dst_fd."""
+    while count:
+        try:
+            # Linux file-to-file copy in the kernel, which some filesystems (Btrfs, XFS, NFS)
+            # can serve by sharing extents or copying server-side
+            sent = os.copy_file_range(src_fd, dst_fd, count, offset)
+        except (AttributeError, OSError):
+            try:
+                # Older kernels and libcs: still zero-copy, the bytes never pass through userspace
+                sent = os.sendfile(dst_fd, src_fd, offset, count)
+            except OSError:
+                # Some platforms (e.g. macOS) only sendfile to sockets
+                sent = os.write(dst_fd, os.pread(src_fd, min(count, TAR_BUFSIZE), offset))
+        if not sent:
+            raise EOFError("Tar member ends before its recorded size")
+        offset += sent
+        count -= sent
+
+def _write_members(old_tar, tar_path, skip_names):
+    """Write old_tar's members except skip_names to a new tar, copying their bodies in the kernel."""
+    src_fd = old_tar.fileobj.fileno()
+    written = 0
+    with open(tar_path, 'wb') as out:
+        for member in old_tar:
+            if member.name in skip_names:
+                continue
+            header = member.tobuf()
+            out.write(header)
+            written += len(header)
+            if member.isreg():
+                out.flush()
+                _copy_range(src_fd, out.fileno(), member.offset_data, member.size)
+                padding = tarfile.NUL * (-member.size % tarfile.BLOCKSIZE)
+                out.write(padding)
+                written += member.size + len(padding)
+        
+        # End-of-archive blocks, filled up to a whole record like TarFile.close()
+        written += 2 * tarfile.BLOCKSIZE
+        out.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE + -written % tarfile.RECORDSIZE))
+
+def _same_content(tar, member, path):
+    """Return True if a tar member holds exactly the bytes of a local file."""
+    if member is None or not member.isreg() or member.size != os.path.getsize(path):
+        return False
+    src_fd = tar.fileobj.fileno()
+    with open(path, 'rb') as f:
+        # Stops at the first differing block, so a changed archive is usually rejected early
+        for offset in range(0, member.size, TAR_BUFSIZE):
+            length = min(TAR_BUFSIZE, member.size - offset)
+            if os.pread(src_fd, length, member.offset_data + offset) != f.read(length):
+                return False
+    return True
+
+def update_master_tar(master_tar_path, new_tgz_paths):
+    """Update master tar with new tgz files in place, returns (its path, whether anything changed)."""
     if not master_tar_path:
-        with tarfile.open(temp_tar_path, 'w') as tar:
-            tar.add(new_tgz_path, arcname=new_tgz_name)
-        return temp_tar_path
+        master_tar_path = LOCAL_MASTER_PATH
+        os.makedirs(MASTER_CACHE_DIR, exist_ok=True)
+        if os.path.exists(master_tar_path):
+            os.remove(master_tar_path)
+        _append_to_tar(master_tar_path, new_tgz_paths)
+        return master_tar_path, True
+    
+    # Same directory as the master, so os.replace never crosses filesystems
+    temp_tar_path = os.path.join(os.path.dirname(master_tar_path), f"temp_{MASTER_TAR_NAME}")
     
-    # Extract existing tar, add/replace file, then recreate
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # Extract existing tar contents
-        with tarfile.open(master_tar_path, 'r') as tar:
-            tar.extractall(path=tmpdir)
+    with tarfile.open(master_tar_path, 'r', copybufsize=TAR_BUFSIZE) as old_tar:
+        # getmembers() scans the headers once; the rebuild iterates that same index.
+        # Later members win on extraction, so the dict keeps the one that counts
+        members = {member.name: member for member in old_tar.getmembers()}
         
-        # Remove existing file if it exists
-        existing_file = os.path.join(tmpdir, new_tgz_name)
-        if os.path.exists(existing_file):
-            os.remove(existing_file)
+        # Archives identical to the member they would replace change nothing
+        new_tgz_paths = [path for path in new_tgz_paths
+                         if not _same_content(old_tar, members.get(tgz_arcname(path)), path)]
+        if not new_tgz_paths:
+            print("Master tar already holds these archives, leaving it unchanged")
+            return master_tar_path, False
+        
+        new_names = {tgz_arcname(path) for path in new_tgz_paths}
+        replacing = not new_names.isdisjoint(members)
+        
+        # Replacing members: copy the kept ones straight into a new tar
+        if replacing:
+            _fadvise(old_tar.fileobj, 'POSIX_FADV_SEQUENTIAL')
+            _write_members(old_tar, temp_tar_path, new_names)
+    
+    if replacing:
+        _append_to_tar(temp_tar_path, new_tgz_paths)
+        os.replace(temp_tar_path, master_tar_path)
+    else:
+        # Tar is concatenable, so brand new files are appended in place
+        _append_to_tar(master_tar_path, new_tgz_paths)
+    return master_tar_path, True
+
+def upload_to_apps_folder(dbx, tgz_paths):
+    """Upload each tgz as its own file under the apps folder, leaving the rest untouched."""
+    staged = []
+    try:
+        # One listing gives every remote hash instead of a metadata call per file,
+        # and the revs the manifest starts from
+        remote_files = _remote_files(dbx, DROPBOX_APPS_FOLDER)
+        revs = {name: metadata.rev for name, metadata in remote_files.items()}
+        for tgz_path in tgz_paths:
+            tgz_name = tgz_arcname(tgz_path)
+            dropbox_path = f"{DROPBOX_APPS_FOLDER}/{tgz_name}"
+            if tgz_name in remote_files and dropbox_content_hash(tgz_path) == remote_files[tgz_name].content_hash:
+                print(f"{dropbox_path} is already up to date, skipping upload")
+                continue
+            commit = _commit_info(tgz_path, dropbox_path)
+            staged.append((tgz_path, dropbox.files.UploadSessionFinishArg(_stage_upload(dbx, tgz_path), commit)))
         
-        # Copy new file into directory
-        import shutil
-        shutil.copy(new_tgz_path, os.path.join(tmpdir, new_tgz_name))
+        # Commit the staged sessions together, one round trip per batch instead of per file
+        for start in range(0, len(staged), FINISH_BATCH_LIMIT):
+            batch = staged[start:start + FINISH_BATCH_LIMIT]
+            result = dbx.files_upload_session_finish_batch_v2([entry for _, entry in batch])
+            for (tgz_path, entry), entry_result in zip(batch, result.entries):
+                if entry_result.is_failure():
+                    print(f"Error uploading {tgz_path} to Dropbox: {entry_result.get_failure()}")
+                    sys.exit(1)
+                revs[tgz_arcname(tgz_path)] = entry_result.get_success().rev
+                print(f"Successfully uploaded {tgz_path} to Dropbox")
+    except Exception as e:
+        print(f"Error uploading to Dropbox: {e}")
+        sys.exit(1)
+    
+    # Checked on every run, so a manifest left stale by a failed write catches up
+    write_manifest(dbx, revs)
+
+def write_manifest(dbx, revs):
+    """Publish {name: rev} of the apps folder, so consumers can see what changed from one small file."""
+    data = json.dumps({name: revs[name] for name in sorted(revs)}, indent=2).encode()
+    try:
+        remote_manifest = _remote_metadata(dbx, DROPBOX_MANIFEST_PATH)
+        if remote_manifest and remote_manifest.content_hash == _bytes_content_hash(data):
+            return
+        dbx.files_upload(data, DROPBOX_MANIFEST_PATH, mode=dropbox.files.WriteMode.overwrite)
+    except ApiError as err:
+        print(f"Error writing manifest to Dropbox: {err}")
+        sys.exit(1)
+    print(f"Updated manifest at {DROPBOX_MANIFEST_PATH}")
+
+def rebuild_master_from_folder(dbx):
+    """Regenerate the master tar from the apps folder, for consumers that need a single file."""
+    master_tar_path = LOCAL_MASTER_PATH
+    try:
+        app_names = sorted(_remote_files(dbx, DROPBOX_APPS_FOLDER))
+        if not app_names:
+            print(f"No apps found in {DROPBOX_APPS_FOLDER}")
+            return
+        # Lets the upload be skipped when the rebuild reproduces the current master
+        remote_master = _remote_metadata(dbx, DROPBOX_FILE_PATH)
         
-        # Create new tar file
-        with tarfile.open(temp_tar_path, 'w') as tar:
-            for file in os.listdir(tmpdir):
-                tar.add(os.path.join(tmpdir, file), arcname=file)
+        # Each app streams from its download straight into the tar, with no temp copy
+        os.makedirs(MASTER_CACHE_DIR, exist_ok=True)
+        with tarfile.open(master_tar_path, 'w|', bufsize=TAR_BUFSIZE, copybufsize=TAR_BUFSIZE) as tar:
+            for app_name in app_names:
+                metadata, res = dbx.files_download(f"{DROPBOX_APPS_FOLDER}/{app_name}")
+                with closing(res):
+                    res.raw.decode_content = True
+                    member = tarfile.TarInfo(app_name)
+                    member.size = metadata.size
+                    # Whole seconds keep it a plain ustar header, with no PAX mtime record
+                    member.mtime = int(metadata.client_modified.replace(tzinfo=timezone.utc).timestamp())
+                    tar.addfile(member, res.raw)
+    except ApiError as err:
+        print(f"Error downloading from Dropbox: {err}")
+        sys.exit(1)
+    
+    # The rebuilt master may lack archives master mode recorded as uploaded
+    clear_upload_state('master')
     
-    return temp_tar_path
+    # Left in MASTER_CACHE_DIR, so the next master mode run needn't download it
+    upload_to_dropbox(dbx, master_tar_path, remote_hash=remote_master.content_hash if remote_master else None)
+
+def _fingerprint(path):
+    """Return the (size, mtime) fingerprint used to spot unchanged archives."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_upload_state(upload_mode):
+    """Return {path: fingerprint} of the archives uploaded by the last successful run in this mode."""
+    try:
+        with open(UPLOAD_STATE_FILE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return state.get('files', {}) if state.get('mode') == upload_mode else {}
+
+def save_upload_state(upload_mode, upload_state, uploaded_paths):
+    """Record the fingerprints of uploaded archives so the next run can skip them."""
+    files = dict(upload_state)
+    files.update({os.path.normpath(path): _fingerprint(path) for path in uploaded_paths})
+    with open(UPLOAD_STATE_FILE, 'w') as f:
+        json.dump({'mode': upload_mode, 'files': files}, f)
 
-def process_files(changed_files, access_token):
+def clear_upload_state(upload_mode):
+    """Forget the archives recorded for upload_mode, so its next run processes them all again."""
+    try:
+        with open(UPLOAD_STATE_FILE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return
+    if state.get('mode') == upload_mode:
+        os.remove(UPLOAD_STATE_FILE)
+
+def process_files(changed_files, access_token, upload_mode='master'):
     """Main processing function."""
+    file_paths = find_archives() if changed_files is None else changed_files.split(',')
+    archive_paths = [os.path.normpath(path.strip()) for path in file_paths if path.strip().endswith(ARCHIVE_SUFFIXES)]
+    
+    # On a full tree scan, archives untouched since the last successful run need no
+    # Dropbox call at all; files named on the command line are always processed
+    upload_state = load_upload_state(upload_mode)
+    if changed_files is None:
+        archive_paths = [path for path in archive_paths if upload_state.get(path) != _fingerprint(path)]
+    
+    if not archive_paths:
+        print("No files to process")
+        return
+    
     dbx = initialize_dropbox(access_token)
     
-    for file_path in changed_files.split(','):
-        if not file_path.strip():
-            continue
-            
-        file_path = file_path.strip()
-        print(f"Processing file: {file_path}")
-        
-        # Step 1: Convert to .tgz if needed
-        processed_path = convert_to_tgz_if_needed(file_path)
-        tgz_name = os.path.basename(processed_path)
-        
-        # Step 2: Download existing master tar from Dropbox
-        master_tar_path = download_from_dropbox(dbx)
-        
-        # Step 3: Update master tar with new file
-        updated_tar_path = update_master_tar(master_tar_path, processed_path)
-        
-        # Step 4: Upload updated tar to Dropbox
+    # Step 1: Archives keep their names on disk; .tar.gz only becomes .tgz in Dropbox
+    for file_path in archive_paths:
+        print(f"Processing file: {file_path} as {tgz_arcname(file_path)}")
+    
+    # Folder mode has no master tar to download, repack or re-upload
+    if upload_mode == 'folder':
+        upload_to_apps_folder(dbx, archive_paths)
+        save_upload_state(upload_mode, upload_state, archive_paths)
+        return
+    
+    # Step 2: Download existing master tar from Dropbox once for all files
+    master_tar_path = download_from_dropbox(dbx)
+    
+    # Step 3: Update master tar with every new file
+    updated_tar_path, changed = update_master_tar(master_tar_path, archive_paths)
+    
+    # Step 4: Upload updated tar to Dropbox in a single write; an unchanged
+    # master still matches the remote one, so there is nothing to hash or send
+    if changed:
         upload_to_dropbox(dbx, updated_tar_path)
-        
-        # Cleanup
-        if master_tar_path and os.path.exists(master_tar_path):
-            os.remove(master_tar_path)
-        if os.path.exists(updated_tar_path):
-            os.remove(updated_tar_path)
+    
+    # The updated master stays in MASTER_CACHE_DIR for the next run
+    save_upload_state(upload_mode, upload_state, archive_paths)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python upload_to_dropbox.py <changed_files>")
+    if len(sys.argv) > 2:
+        print("Usage: python upload_to_dropbox.py [changed_files]")
         sys.exit(1)
         
     access_token = os.getenv('DROPBOX_ACCESS_TOKEN')
@@ -130,5 +486,16 @@ if __name__ == "__main__":
         print("ERROR: Dropbox access token not found in environment variables")
         sys.exit(1)
         
-    changed_files = sys.argv[1]
-    process_files(changed_files, access_token)
+    upload_mode = os.getenv('DROPBOX_UPLOAD_MODE', 'master')
+    if upload_mode not in UPLOAD_MODES:
+        print(f"ERROR: DROPBOX_UPLOAD_MODE must be one of {', '.join(UPLOAD_MODES)}")
+        sys.exit(1)
+        
+    # Rebuild runs out of band and ignores changed files
+    if upload_mode == 'rebuild':
+        rebuild_master_from_folder(initialize_dropbox(access_token))
+        sys.exit(0)
+        
+    # Without a changed files list, every archive in the working tree is processed
+    changed_files = sys.argv[1] if len(sys.argv) == 2 else None
+    process_files(changed_files, access_token, upload_mode)